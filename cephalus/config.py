@@ -38,3 +38,14 @@ class StateKernelConfig:
     # TODO: Replace assumed data types with references to this throughout the code.
     # The data type that will be used for models when they interface with the kernel.
     dtype: tf.DType = tf.float32
+
+    # Whether fixed-shape hot-path functions such as state prediction should be compiled with
+    # XLA. This is usually a significant win for the small, statically-shaped models the kernel
+    # uses, but it can be disabled if XLA compilation causes memory or compatibility problems on
+    # a particular platform.
+    jit_compile: bool = True
+
+    # Whether to check state predictions, losses, and gradients for NaN/Inf values on every step.
+    # Each check forces a host/device synchronization, so this should only be enabled when
+    # debugging numerical problems.
+    check_numerics: bool = False
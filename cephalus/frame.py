@@ -1,10 +1,10 @@
-from dataclasses import dataclass, field
-from typing import Optional, List, Union, Dict, Any, TYPE_CHECKING
+from dataclasses import dataclass
+from typing import Optional, List, Union, Any, TYPE_CHECKING
 
 import tensorflow as tf
 
 if TYPE_CHECKING:
-    from cephalus.modules.interface import StateKernelModule, InputSample
+    from cephalus.modules.interface import InputSample
 
 __all__ = [
     'StateFrame'
@@ -14,10 +14,12 @@ __all__ = [
 # TODO: Consider renaming StateFrame to StateDecision, or ActionDecision to ActionFrame, to
 #       emphasize their parallel nature.
 
-@dataclass
+@dataclass(slots=True)
 class StateFrame:
     """A collection of all the information collected about a state prediction which may be required
-    to train the kernel. Kernels may subclass this and add their own fields."""
+    to train the kernel. Kernels may subclass this and add their own fields. A frame is allocated
+    on every step, so the class is slotted to avoid paying for a per-instance __dict__; subclasses
+    should also pass slots=True to keep that benefit."""
 
     stream_id: str  # Useful for tracing/debugging
     previous_state: Union[tf.Tensor, tf.Variable]
@@ -25,8 +27,8 @@ class StateFrame:
 
     clock_ticks: int = 0
 
-    input_samples: List['InputSample'] = None
-    attended_input_tensor: tf.Tensor = None
+    input_samples: Optional[List['InputSample']] = None
+    attended_input_tensor: Optional[tf.Tensor] = None
     current_state: Optional[tf.Tensor] = None
 
     # The combined loss of the current state, including discounted estimated future loss. Analogous
@@ -37,4 +39,7 @@ class StateFrame:
 
     trained: bool = False
 
-    module_data: Dict['StateKernelModule', Dict[str, Any]] = field(default_factory=dict)
+    # Per-module frame data, indexed by each module's kernel-assigned module_id. A flat list
+    # avoids hashing module instances and allocating a fresh dict for every frame. The kernel
+    # preallocates the list to the module count when it creates the frame.
+    module_data: Optional[List[Any]] = None
@@ -1,8 +1,8 @@
 """The state kernel is a configurable kernel for online neural learning of sequential state updates.
 This module defines the state kernel and the abstract interfaces for its modules."""
 import logging
-from typing import Optional, Union, Iterable, Tuple, Set, TypeVar, \
-    Generic, List
+from typing import Optional, Union, Iterable, Tuple, Dict, TypeVar, \
+    Generic, List, Callable, Sequence
 
 import tensorflow as tf
 from tensorflow.keras.optimizers import Optimizer
@@ -40,15 +40,25 @@ class StateKernel(Modeled, Generic[Environment]):
     _config: Optional[StateKernelConfig] = None
     _initial_state: Union[tf.Tensor, tf.Variable] = None
     _initial_state_is_trainable: bool = False
-    _modules: Set['StateKernelModule[Environment]']
+    # Modules are kept in insertion order so that iteration over them -- and the caches derived
+    # from them -- is deterministic.
+    _modules: Dict['StateKernelModule[Environment]', None]
     _input_attention_provider: 'InputAttentionProvider' = None
     _state_prediction_provider: 'StatePredictionProvider' = None
     _retroactive_gradient_provider: 'RetroactiveLossProvider' = None
     _trainable_weights: Tuple[tf.Variable, ...] = None
+    _apply_gradients_op: Optional[Callable] = None
+    _gradient_clip_norm: Optional[tf.Tensor] = None
+    _loss_module_scales: Tuple[tf.Tensor, ...] = ()
+    _loss_module_scale_values: Tuple[float, ...] = ()
+    _sensors: Tuple['Sensor', ...] = ()
+    _retroactive_loss_providers: Tuple['RetroactiveLossProvider', ...] = ()
 
     def __init__(self, modules: Iterable['StateKernelModule[Environment]'] = None,
                  config: Optional[StateKernelConfig] = None, *, name: str = None):
-        self._modules = set()
+        self._modules = {}
+        self._weights_by_module: Dict['StateKernelModule[Environment]',
+                                      Tuple[tf.Variable, ...]] = {}
         if modules:
             self.add_modules(*modules)
         if config is not None:
@@ -60,7 +70,7 @@ class StateKernel(Modeled, Generic[Environment]):
         """Add a module to the state kernel."""
         for module in modules:
             if module not in self._modules:
-                self._modules.add(module)
+                self._modules[module] = None
                 if self._config:
                     module.configure(self)
                     if self._built:
@@ -73,7 +83,7 @@ class StateKernel(Modeled, Generic[Environment]):
         for module in modules:
             assert module is not self._state_prediction_provider
             if module in self._modules:
-                self._modules.remove(module)
+                del self._modules[module]
         if self.is_built:
             self.recompute_trainable_weights()
 
@@ -84,6 +94,7 @@ class StateKernel(Modeled, Generic[Environment]):
 
         # Apply the configuration
         self._config = config
+        self._gradient_clip_norm = tf.constant(1.0, dtype=config.dtype)
         for module in self._modules:
             module.configure(self)
 
@@ -125,6 +136,42 @@ class StateKernel(Modeled, Generic[Environment]):
 
         return frame
 
+    def step_batch(self, environments: Sequence[Environment],
+                   previous_frames: Sequence[Optional[StateFrame]] = None,
+                   stream_ids: Sequence[str] = None) -> List[StateFrame]:
+        """Run the kernel for a single step in each of several environments stepping in lockstep.
+        The state predictions for all the streams are computed with a single batched call to the
+        state prediction provider, amortizing the model's dispatch and kernel-launch costs across
+        the streams instead of paying for one tiny forward pass per stream. Training still happens
+        per stream, since each frame carries its own gradient tape. Return the new frames, in the
+        same order as the environments."""
+        if not self.is_built:
+            self.build()
+        if previous_frames is None:
+            previous_frames = [None] * len(environments)
+        assert len(previous_frames) == len(environments)
+        if stream_ids is None:
+            stream_ids = [None] * len(environments)
+        assert len(stream_ids) == len(environments)
+
+        frames = []
+        for environment, previous_frame, stream_id in zip(environments, previous_frames,
+                                                          stream_ids):
+            frame = self.new_frame(previous_frame, stream_id)
+            self.gather_inputs(environment, frame)
+            self.input_attention_provider.attend_inputs(frame)
+            frames.append(frame)
+
+        new_states = self._state_prediction_provider.predict_state_batch(frames)
+        for frame, new_state in zip(frames, new_states):
+            self._record_predicted_state(frame, new_state)
+
+        for previous_frame, frame in zip(previous_frames, frames):
+            if previous_frame is not None:
+                self.train(previous_frame, frame)
+
+        return frames
+
     @property
     def config(self) -> Optional[StateKernelConfig]:
         """The state kernel's configuration."""
@@ -221,18 +268,53 @@ class StateKernel(Modeled, Generic[Environment]):
         return self._initial_state_is_trainable
 
     def recompute_trainable_weights(self):
-        """Recompute the trainable weights after a configuration or module change."""
+        """Recompute the trainable weights after a configuration or module change. Each module's
+        weights are cached the first time they are enumerated, so recomputing only does real work
+        for modules that were added since the last recompute, and the weight tuple -- along with
+        the traced ops that capture it -- keeps a stable identity when the weights are
+        unchanged."""
         assert self._config
+        # Assign each module its index into the frames' module_data lists.
+        for module_id, module in enumerate(self._modules):
+            module.module_id = module_id
+        # Drop the cached weights of any modules that have been discarded.
+        for module in tuple(self._weights_by_module):
+            if module not in self._modules:
+                del self._weights_by_module[module]
         weights = []
         if self._initial_state_is_trainable:
             assert self.initial_state.dtype == self.dtype
             weights.append(self.initial_state)
         for module in self._modules:
-            module_weights = module.get_trainable_weights()
-            for weight in module_weights:
-                assert weight.dtype == self.dtype, (module, weight.name)
+            module_weights = self._weights_by_module.get(module)
+            if module_weights is None:
+                module_weights = module.get_trainable_weights()
+                for weight in module_weights:
+                    assert weight.dtype == self.dtype, (module, weight.name)
+                self._weights_by_module[module] = module_weights
             weights.extend(module_weights)
-        self._trainable_weights = tuple(weights)
+        weights = tuple(weights)
+        if (self._trainable_weights is None or
+                len(weights) != len(self._trainable_weights) or
+                any(new is not old for new, old in zip(weights, self._trainable_weights))):
+            self._trainable_weights = weights
+            # The traced gradient application op captures the weight tuple, so it must be rebuilt
+            # whenever the weights change.
+            self._apply_gradients_op = None
+        # Precompute the loss scales as constants so the scaling arithmetic in get_loss() does not
+        # have to re-wrap the same Python floats as tensors on every step. The scales are kept
+        # for every module, in module order, because get_loss() must still be called on
+        # zero-scale modules; only their losses are dropped.
+        self._loss_module_scales = tuple(tf.constant(module.loss_scale, dtype=self.dtype)
+                                         for module in self._modules)
+        self._loss_module_scale_values = tuple(float(module.loss_scale)
+                                               for module in self._modules)
+        # Cache typed sub-tuples of the modules so the hot path iterates exactly the modules it
+        # needs instead of filtering the full module collection with isinstance checks per step.
+        self._sensors = tuple(module for module in self._modules
+                              if isinstance(module, Sensor))
+        self._retroactive_loss_providers = tuple(module for module in self._modules
+                                                 if isinstance(module, RetroactiveLossProvider))
 
     def get_trainable_weights(self) -> Tuple[tf.Variable, ...]:
         """Return a tuple of the trainable weights of the neural models used by the state kernel and
@@ -241,36 +323,78 @@ class StateKernel(Modeled, Generic[Environment]):
         assert self._trainable_weights is not None
         return self._trainable_weights
 
+    def get_apply_gradients_op(self) -> Callable:
+        """Return the traced function which clips the loss gradients and applies them to the
+        trainable weights via the optimizer. The function is traced lazily and discarded whenever
+        the trainable weights are recomputed, since the weight tuple is captured by the traced
+        graph. Fusing these operations into a single graph avoids paying per-op eager dispatch
+        overhead on every step."""
+        assert self._config is not None
+        if self._apply_gradients_op is None:
+            weights = self.get_trainable_weights()
+            optimizer = self.optimizer
+            clip_norm = self._gradient_clip_norm
+
+            @tf.function(reduce_retracing=True)
+            def apply_gradients_op(loss_gradients: List[tf.Tensor]) -> None:
+                clipped_gradients, _ = tf.clip_by_global_norm(loss_gradients, clip_norm)
+                gradient_weight_pairs = [(gradient, weight)
+                                         for gradient, weight in zip(clipped_gradients, weights)
+                                         if gradient is not None]
+                if gradient_weight_pairs:
+                    optimizer.apply_gradients(gradient_weight_pairs)
+
+            self._apply_gradients_op = apply_gradients_op
+        return self._apply_gradients_op
+
     def get_loss(self, previous_frame: StateFrame,
                  current_frame: StateFrame) -> Optional[tf.Tensor]:
         """Return the computed loss for the previous frame's state tensor. Values which have already
         been computed for the frame (i.e. the current state) will not be recomputed. Use the
-        provided gradient tape in the decision frame to get the gradients of the parameters."""
+        provided gradient tape in the decision frame to get the gradients of the parameters.
+
+        This is the single aggregation point for the modules' contributions to the state
+        gradient: each module's influence arrives as a scalar loss, and the scaled losses are
+        combined with one stacked reduction, so a single backward pass computes the combined
+        state gradient rather than one gradient computation per module."""
         assert self._config is not None
         assert previous_frame.current_state is not None
 
         losses: List[tf.Tensor] = []
-        for module in self._modules:
+        scales: List[tf.Tensor] = []
+        unit_scaled = True
+        for module, scale, scale_value in zip(self._modules, self._loss_module_scales,
+                                              self._loss_module_scale_values):
+            # Every module's get_loss() must be called, even when its loss is scaled to zero --
+            # some modules (e.g. reward-driven tasks) drive their environment interactions from
+            # this call. The scale only filters the loss's inclusion in the total.
             module_loss = module.get_loss(previous_frame, current_frame)
-            if module_loss is not None and module.loss_scale > 0.0:
+            if module_loss is not None and scale_value > 0.0:
                 assert module_loss.shape == (), "Invalid loss shape returned from %r" % module
-                # noinspection PyTypeChecker
-                scaled_module_loss: tf.Tensor = module.loss_scale * module_loss
-                losses.append(scaled_module_loss)
+                losses.append(module_loss)
+                scales.append(scale)
+                unit_scaled = unit_scaled and scale_value == 1.0
 
                 # TODO: Provide a way for the user to capture loss curves over time for each
                 #       module and retrieve them easily. And modules should be named (manually,
                 #       or else automatically at config time with a reasonable default) so we
                 #       can identify them easily.
-                LOGGER.info("Loss for module %s in stream %s: %s", module.__class__.__name__,
-                            previous_frame.stream_id, scaled_module_loss.numpy())
+                if LOGGER.isEnabledFor(logging.INFO):
+                    LOGGER.info("Loss for module %s in stream %s: %s", module.__class__.__name__,
+                                previous_frame.stream_id, (scale * module_loss).numpy())
 
-        if len(losses) == 1:
-            return losses[0]
-        elif losses:
-            return tf.add_n(losses)
-        else:
+        if not losses:
             return None
+        if unit_scaled:
+            # Scaling is a no-op when every active scale is exactly 1, which is the common default
+            # configuration; return the loss (or plain sum) without the multiplies.
+            return losses[0] if len(losses) == 1 else tf.add_n(losses)
+        if len(losses) == 1:
+            # No reduction needed for a single loss; just scale it.
+            return scales[0] * losses[0]
+        # A single stacked reduction launches far fewer kernels than scaling each module's
+        # loss individually and summing the results.
+        return tf.tensordot(tf.stack(losses), tf.stack(scales), 1)
 
     def get_previous_state(self, previous_frame: StateFrame = None) -> Union[tf.Tensor,
                                                                              tf.Variable]:
@@ -284,13 +408,13 @@ class StateKernel(Modeled, Generic[Environment]):
         return previous_state
 
     def new_gradient_tape(self) -> Optional[tf.GradientTape]:
-        """Return a new gradient tape, which is already open and set to record the trainable
-         weights."""
+        """Return a new gradient tape, which is already open and recording. Trainable variables
+        are watched automatically as they are accessed, so there is no need to register each
+        weight with the tape, and the tape does not need to be persistent since only a single
+        gradient call is made per frame."""
         assert self._config is not None
-        tape = tf.GradientTape(persistent=True, watch_accessed_variables=False)
+        tape = tf.GradientTape()
         tape.__enter__()  # TODO: Is there a cleaner way to do this?
-        for weight in self.get_trainable_weights():
-            tape.watch(weight)
         return tape
 
     def new_frame(self, previous_frame: StateFrame = None, stream_id: str = None) -> StateFrame:
@@ -304,11 +428,12 @@ class StateKernel(Modeled, Generic[Environment]):
             previous_state=self.get_previous_state(previous_frame),
             tape=self.new_gradient_tape(),
             clock_ticks=0 if previous_frame is None else 1 + previous_frame.clock_ticks,
+            module_data=[None] * len(self._modules),
         )
         for module in self._modules:
             module_data = module.get_new_frame_data(new_frame, previous_frame)
             if module_data is not None:
-                new_frame.module_data[module] = module_data
+                new_frame.module_data[module.module_id] = module_data
         LOGGER.info("Incremented clock tick to %s for stream %s.", new_frame.clock_ticks, stream_id)
         return new_frame
 
@@ -318,9 +443,7 @@ class StateKernel(Modeled, Generic[Environment]):
         assert frame.current_state is None
         assert frame.input_samples is None
         samples: List[InputSample] = []
-        for module in self._modules:
-            if not isinstance(module, Sensor):
-                continue
+        for module in self._sensors:
             for sample in module.get_inputs(environment, frame):
                 assert sample.value.shape == (self.input_width,)
                 samples.append(sample)
@@ -334,9 +457,13 @@ class StateKernel(Modeled, Generic[Environment]):
         assert frame.current_state is None
         assert self._state_prediction_provider is not None
         new_state = self._state_prediction_provider.predict_state(frame)
+        self._record_predicted_state(frame, new_state)
+
+    def _record_predicted_state(self, frame: StateFrame, new_state: tf.Tensor) -> None:
+        """Validate a provider's state prediction and record it in the frame."""
         assert new_state is not None
-        assert not tf.reduce_any(tf.math.is_nan(new_state))
-        new_state = tf.clip_by_value(new_state, -1e6, 1e6)
+        if self._config.check_numerics:
+            tf.debugging.assert_all_finite(new_state, "Non-finite state prediction.")
         frame.current_state = new_state
 
     def train(self, previous_frame: StateFrame, current_frame: StateFrame) -> None:
@@ -350,34 +477,34 @@ class StateKernel(Modeled, Generic[Environment]):
         #       should be moved back into the stop_recording().
         try:
             loss = self.get_loss(previous_frame, current_frame)
-            assert loss.dtype == self.dtype
-            if loss is None:
-                loss = tf.zeros(())
         finally:
+            # The tape must come off the global tape stack even if a module raises, or every
+            # subsequent op in the process would be silently recorded onto it.
             previous_frame.tape.__exit__(None, None, None)
+        if loss is None:
+            loss = tf.zeros(())
+        assert loss.dtype == self.dtype
 
         with current_frame.tape.stop_recording():
             tf.assert_rank(loss, 0)
-            assert not tf.math.is_nan(loss)
 
             weights = self.get_trainable_weights()
             loss_gradients = previous_frame.tape.gradient(loss, weights)
-            assert not any(tf.reduce_any(tf.math.is_nan(loss_gradient))
-                           for loss_gradient in loss_gradients
-                           if loss_gradient is not None)
-            loss_gradients, _ = tf.clip_by_global_norm(loss_gradients, 1.0)
-            gradient_weight_pairs = [(gradient, weight)
-                                     for gradient, weight in zip(loss_gradients, weights)
-                                     if gradient is not None]
-            if gradient_weight_pairs:
-                self.optimizer.apply_gradients(gradient_weight_pairs)
+            if self._config.check_numerics:
+                # A single fused check over the flattened gradients costs one host/device sync
+                # rather than one per gradient tensor.
+                tf.debugging.assert_all_finite(loss, "Non-finite loss.")
+                flat_gradients = tf.concat([tf.reshape(loss_gradient, [-1])
+                                            for loss_gradient in loss_gradients
+                                            if loss_gradient is not None], axis=0)
+                tf.debugging.assert_all_finite(flat_gradients, "Non-finite loss gradient.")
+            self.get_apply_gradients_op()(loss_gradients)
 
             # Train the loss providers here, before we remove the tape, in case they need gradient
             # information.
             previous_frame.combined_loss = loss
-            for module in self._modules:
-                if isinstance(module, RetroactiveLossProvider):
-                    module.train_retroactive_loss(previous_frame, current_frame)
+            for module in self._retroactive_loss_providers:
+                module.train_retroactive_loss(previous_frame, current_frame)
 
         previous_frame.tape = None
         previous_frame.trained = True
@@ -130,16 +130,18 @@ class StandardInputAttentionProvider(InputAttentionProvider):
         assert frame.previous_state is not None
         assert frame.attended_input_tensor is None
 
-        input_tensors = []
-        for sample in frame.input_samples:
-            input_tensors.append(self.get_annotated_tensor(sample, frame))
-
-        if not input_tensors:
-            sample = InputSample('<DEFAULT>', self.default_sensor_embedding, self.default_input, 0)
-            input_tensors.append(self.get_annotated_tensor(sample, frame))
-
-        input_tensors = tf.concat([input_tensor[tf.newaxis, :] for input_tensor in input_tensors],
-                                  axis=0)
+        samples = frame.input_samples
+        if not samples:
+            samples = [InputSample('<DEFAULT>', self.default_sensor_embedding,
+                                   self.default_input, 0)]
+
+        # Annotate and stack the samples with a handful of batched ops, rather than concatenating
+        # each sample's annotations individually and then stacking the results.
+        ages = tf.constant([[1.0 - 1.0 / (1.0 + frame.clock_ticks - sample.time_stamp)]
+                            for sample in samples], dtype=self.kernel.dtype)
+        embeddings = tf.stack([sample.sensor_embedding for sample in samples], axis=0)
+        values = tf.stack([sample.value for sample in samples], axis=0)
+        input_tensors = tf.concat([ages, embeddings, values], axis=-1)
 
         attended_input = self._input_attention_function(frame.previous_state, input_tensors)
 
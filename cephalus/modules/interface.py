@@ -1,6 +1,7 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Optional, Union, Dict, Any, TYPE_CHECKING, TypeVar, Generic, Tuple, Iterable
+from typing import Optional, Union, Dict, Any, TYPE_CHECKING, TypeVar, Generic, Tuple, Iterable, \
+    List, Sequence
 
 import tensorflow as tf
 
@@ -29,6 +30,7 @@ class StateKernelModule(Modeled, Generic[Environment]):
 
     _kernel: Optional['StateKernel'] = None
     _loss_scale: float = 1.0
+    _module_id: Optional[int] = None
 
     def __init__(self, *, loss_scale: float = None, name: str = None):
         self._loss_scale = 1.0 if loss_scale is None else float(loss_scale)
@@ -56,9 +58,22 @@ class StateKernelModule(Modeled, Generic[Environment]):
     def get_new_frame_data(self, frame: 'StateFrame',
                            previous_frame: 'StateFrame' = None) -> Optional[Dict[str, Any]]:
         """Return any additional initialization information specific to the module that must be
-        stored in the frame. The module's data will be stored in frame.module_data[module]."""
+        stored in the frame. The module's data will be stored in
+        frame.module_data[module.module_id]."""
         return None
 
+    @property
+    def module_id(self) -> Optional[int]:
+        """The module's index into each frame's module_data list. Assigned by the kernel whenever
+        its module caches are recomputed."""
+        return self._module_id
+
+    @module_id.setter
+    def module_id(self, value: int) -> None:
+        """The module's index into each frame's module_data list. Assigned by the kernel whenever
+        its module caches are recomputed."""
+        self._module_id = value
+
     @property
     def kernel(self) -> Optional['StateKernel']:
         """The state kernel this module is configured for."""
@@ -82,6 +97,9 @@ class StateKernelModule(Modeled, Generic[Environment]):
         """A coefficient applied to the module's loss to scale its effects relative to other
         state prediction losses."""
         self._loss_scale = value
+        if self._kernel is not None and self._kernel.is_built:
+            # The kernel caches the loss scales as constants, so they must be recomputed.
+            self._kernel.recompute_trainable_weights()
 
     @property
     def dtype(self) -> tf.DType:
@@ -135,9 +153,20 @@ class StatePredictionProvider(StateKernelModule, ABC):
 
     @abstractmethod
     def predict_state(self, frame: 'StateFrame') -> tf.Tensor:
-        """Predict the current state from the previous state and the current input."""
+        """Predict the current state from the previous state and the current input.
+
+        The returned state should be bounded to a reasonable range; the kernel no longer clamps
+        predictions on the provider's behalf, so any clipping belongs in the provider's own
+        (preferably traced) computation."""
         raise NotImplementedError()
 
+    def predict_state_batch(self, frames: Sequence['StateFrame']) -> List[tf.Tensor]:
+        """Predict the current state for each of several frames stepping in lockstep. The default
+        implementation simply predicts each frame's state serially; providers whose models accept
+        a batch dimension should override this to make a single batched call instead of one tiny
+        forward pass per stream."""
+        return [self.predict_state(frame) for frame in frames]
+
 
 class RetroactiveLossProvider(StateKernelModule, ABC):
     """A state kernel module which provides retroactive state gradients for its kernel. At most one
@@ -1,5 +1,5 @@
 import logging
-from typing import Union, Optional, TYPE_CHECKING, Tuple, Callable
+from typing import Union, Optional, TYPE_CHECKING, Tuple, Callable, Dict
 
 import tensorflow as tf
 
@@ -18,8 +18,6 @@ LOGGER = logging.getLogger(__name__)
 
 
 class TDAgent(StateKernelModule):
-    max_observable_reward: float = None
-    min_observable_reward: float = None
     episodes: int = 0
     total_steps: int = 0
 
@@ -34,6 +32,17 @@ class TDAgent(StateKernelModule):
         self._doubt_estimator: 'DoubtEstimator' = doubt_estimator
         self._previous_decision: Optional[ActionDecision] = None
         self._current_decision: Optional[ActionDecision] = None
+        self._discount_constants: Dict[float, Tuple[tf.Tensor, tf.Tensor]] = {}
+        # The observed reward bounds are tracked on-device so updating them with tensor rewards
+        # does not force a host/device synchronization on every step. The bounds start out
+        # deliberately inverted (min = +inf, max = -inf) so the first tf.maximum/tf.minimum
+        # update snaps them to the first observed reward. They must not be used for clipping
+        # until then; this is safe only because accept_reward() and reset() always update them
+        # before the stabilized path in _update_previous_decision() reads them.
+        self._max_observable_reward = tf.Variable(float('-inf'), dtype=tf.float32,
+                                                  trainable=False)
+        self._min_observable_reward = tf.Variable(float('inf'), dtype=tf.float32,
+                                                  trainable=False)
 
         super().__init__(name=name)
 
@@ -41,6 +50,16 @@ class TDAgent(StateKernelModule):
     def q_model(self) -> 'ProbabilisticModel':
         return self._q_model
 
+    @property
+    def max_observable_reward(self) -> tf.Variable:
+        """The highest reward value observed so far, tracked on-device."""
+        return self._max_observable_reward
+
+    @property
+    def min_observable_reward(self) -> tf.Variable:
+        """The lowest reward value observed so far, tracked on-device."""
+        return self._min_observable_reward
+
     @property
     def doubt_estimator(self) -> Optional['DoubtEstimator']:
         return self._doubt_estimator
@@ -60,6 +79,18 @@ class TDAgent(StateKernelModule):
             assert isinstance(self.discount, float)
             return self.discount
 
+    def get_discount_constants(self) -> Tuple[tf.Tensor, tf.Tensor]:
+        """Return the current discount and 1 + discount as tensors. The constants are cached per
+        discount value so the same Python floats are not re-wrapped as fresh tensors on every
+        step of the update arithmetic."""
+        discount = self.get_discount()
+        constants = self._discount_constants.get(discount)
+        if constants is None:
+            constants = (tf.constant(discount, dtype=tf.float32),
+                         tf.constant(1.0 + discount, dtype=tf.float32))
+            self._discount_constants[discount] = constants
+        return constants
+
     def configure(self, kernel: 'StateKernel') -> None:
         super().configure(kernel)
         if isinstance(self._doubt_estimator, StateKernelModule):
@@ -93,40 +124,40 @@ class TDAgent(StateKernelModule):
         assert self._previous_decision.reward is not None
         assert self._previous_decision.q_value_target is None
 
+        discount, one_plus_discount = self.get_discount_constants()
         if self._current_decision:
             assert self._current_decision.reward is None
-            # noinspection PyTypeChecker
-            prediction = float(self._current_decision.exploit_q_value_prediction)
-            discount = self.get_discount()
-
+            prediction = self._current_decision.exploit_q_value_prediction
             if self.stabilize:
                 # Sometimes the model can generalize poorly, resulting in predicted values that are
                 # outside the bounds of what is actually reasonable.
-                if self.min_observable_reward is not None:
-                    prediction = max(prediction, self.min_observable_reward)
-                if self.max_observable_reward is not None:
-                    prediction = min(prediction, self.max_observable_reward)
-                previous_q_value = ((self._previous_decision.reward + discount * prediction) /
-                                    (1.0 + discount))
-            else:
-                # noinspection PyTypeChecker
-                previous_q_value = self._previous_decision.reward + discount * prediction
+                prediction = tf.clip_by_value(prediction, self._min_observable_reward,
+                                              self._max_observable_reward)
         else:
-            if self.stabilize:
-                discount = self.get_discount()
-                previous_q_value = self._previous_decision.reward / (1.0 + discount)
-            else:
-                previous_q_value = self._previous_decision.reward
+            # With no successor decision, the predicted future value is zero.
+            prediction = 0.0
+
+        # The four previous arithmetic branches collapse into one formula: the end-of-episode
+        # cases are just the prediction going to zero, and stabilization is just a rescaling of
+        # the target. The prediction stays on-device as a tensor rather than being pulled back to
+        # the host with float().
+        # noinspection PyTypeChecker
+        previous_q_value = self._previous_decision.reward + discount * prediction
+        if self.stabilize:
+            previous_q_value = previous_q_value / one_plus_discount
 
         self._previous_decision.q_value_target = previous_q_value
 
     def _close_previous_decision(self) -> Optional[tf.Tensor]:
         if self._previous_decision:
-            LOGGER.info("Previous step's predicted Q-value for task %s: %s", self,
-                        self._previous_decision.selected_q_value_prediction.numpy())
-            # noinspection PyTypeChecker
-            LOGGER.info("Previous step's target Q-value for task %s: %s", self,
-                        float(self._previous_decision.q_value_target))
+            # The .numpy()/float() conversions force a host/device sync, so they are only paid
+            # when debug logging is actually enabled.
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("Previous step's predicted Q-value for task %s: %s", self,
+                             self._previous_decision.selected_q_value_prediction.numpy())
+                # noinspection PyTypeChecker
+                LOGGER.debug("Previous step's target Q-value for task %s: %s", self,
+                             float(self._previous_decision.q_value_target))
             policy_loss = self._action_policy.get_loss(self._previous_decision)
             if self._previous_decision:
                 previous_doubt = self._previous_decision.doubt
@@ -171,14 +202,8 @@ class TDAgent(StateKernelModule):
         if self.stabilize:
             reward = 0.0
 
-            if self.max_observable_reward is None:
-                self.max_observable_reward = reward
-            else:
-                self.max_observable_reward = max(reward, self.max_observable_reward)
-            if self.min_observable_reward is None:
-                self.min_observable_reward = reward
-            else:
-                self.min_observable_reward = min(reward, self.min_observable_reward)
+            self._max_observable_reward.assign(tf.maximum(self._max_observable_reward, reward))
+            self._min_observable_reward.assign(tf.minimum(self._min_observable_reward, reward))
 
             LOGGER.info("Max observable reward for task %s: %s", self, self.max_observable_reward)
             LOGGER.info("Min observable reward for task %s: %s", self, self.min_observable_reward)
@@ -208,14 +233,8 @@ class TDAgent(StateKernelModule):
         self._current_decision.reward = reward
 
         if self.stabilize:
-            if self.max_observable_reward is None:
-                self.max_observable_reward = reward
-            else:
-                self.max_observable_reward = max(reward, self.max_observable_reward)
-            if self.min_observable_reward is None:
-                self.min_observable_reward = reward
-            else:
-                self.min_observable_reward = min(reward, self.min_observable_reward)
+            self._max_observable_reward.assign(tf.maximum(self._max_observable_reward, reward))
+            self._min_observable_reward.assign(tf.minimum(self._min_observable_reward, reward))
 
             LOGGER.info("Max observable reward for task %s: %s", self, self.max_observable_reward)
             LOGGER.info("Min observable reward for task %s: %s", self, self.min_observable_reward)
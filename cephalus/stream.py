@@ -1,12 +1,13 @@
 """A harness which links a state kernel to its environment, coordinating their interactions."""
 
-from typing import Callable, Optional, TypeVar, Generic
+from typing import Callable, Optional, TypeVar, Generic, Sequence
 
 from cephalus.frame import StateFrame
 from cephalus.kernel import StateKernel
 
 __all__ = [
-    'StateStream'
+    'StateStream',
+    'step_streams'
 ]
 
 from cephalus.names import Named
@@ -50,3 +51,19 @@ class StateStream(Named, Generic[Environment]):
         """Run the kernel for a single step in the environment."""
         frame = self._kernel.step(self._environment, self._previous_frame, self.name)
         self._previous_frame = frame
+
+
+def step_streams(streams: Sequence[StateStream]) -> None:
+    """Run several streams sharing a single kernel for one step each, in lockstep. The streams'
+    state predictions are computed with a single batched call to the kernel, which is considerably
+    faster than stepping each stream individually when many streams are maintained
+    concurrently."""
+    if not streams:
+        return
+    kernel = streams[0].kernel
+    assert all(stream.kernel is kernel for stream in streams)
+    frames = kernel.step_batch([stream.environment for stream in streams],
+                               [stream._previous_frame for stream in streams],
+                               [stream.name for stream in streams])
+    for stream, frame in zip(streams, frames):
+        stream._previous_frame = frame
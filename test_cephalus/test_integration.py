@@ -22,7 +22,7 @@ from cephalus.q.epsilon_greedy import EpsilonGreedy
 from cephalus.q.probabilistic_models import DeterministicModel
 from cephalus.q.tasks import RewardDrivenTask
 from cephalus.q.td import TDAgent
-from cephalus.stream import StateStream
+from cephalus.stream import StateStream, step_streams
 
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -213,15 +213,14 @@ def test_multiple_streams(steps: Optional[int] = 10, stream_count: int = 2):
         streams.append(stream)
 
     print("Running the state streams.")
-    # TODO: This isn't true concurrency. For that, we will need to do some locking in the kernel.
+    # The streams share a kernel, so they are advanced in lockstep with a single batched state
+    # prediction per step rather than being stepped round-robin.
     if steps is None:
         while True:
-            for stream in streams:
-                stream.step()
+            step_streams(streams)
     else:
         for step in range(steps):
-            for stream in streams:
-                stream.step()
+            step_streams(streams)
 
     for stream in streams:
         print("Closing the solvers.")